@@ -23,7 +23,7 @@ Octrees
 """
 
 from octrees.octrees import Octree, octree_from_list
-from octrees.blob_octrees import BlobOctree
+from octrees.blob_octrees import BlobOctree, blob_octree_from_list
 
 import octrees.geometry
 
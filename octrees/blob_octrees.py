@@ -39,13 +39,19 @@ class BlobOctree(object):
 
     Usage:
         BlobOctree((minx, maxx), (miny, maxy), (minz, maxz))
-    creates an empty blob octree with bounds as given.
+    creates an empty blob octree with bounds as given, and
+        blob_octree_from_list(bounds, l)
+    builds one from a list of triples (p, b, d).
     """
 
     def __init__(self, bounds, tree=BlobTree.empty()):
         self.bounds = bounds
         self.tree = tree
 
+    def in_bounds(self, p):
+        "Does p lie within the bounds?"
+        return point_in_box(p, self.bounds)
+
     def check_bounds(self, p):
         if not point_in_box(p, self.bounds):
             raise KeyError("Point (%s, %s, %s) out of bounds" % p)
@@ -88,8 +94,22 @@ class BlobOctree(object):
         return BlobOctree(self.bounds, self.tree)
 
     def extend(self, g):
-        for (p, b, d) in g:
-            self.insert(p, b, d)
+        """
+        Inserts all the regions in g, given as triples (p, b, d).
+
+        If self is empty, the tree is built in one go (which is much
+        faster than inserting the regions one at a time).
+        """
+        if isinstance(self.tree, BlobEmpty):
+            l = []
+            for (p, b, d) in g:
+                self.check_bounds(p)
+                l.append((p, (b, d)))
+            self.tree = octree_from_list_inner(self.bounds, l, 0, len(l),
+                                               BlobTree)
+        else:
+            for (p, b, d) in g:
+                self.insert(p, b, d)
 
     def intersection_with_box(self, b):
         """
@@ -104,6 +124,15 @@ class BlobOctree(object):
         for t in self.tree.intersect_with_box(b):
             yield t
 
+    def freeze(self):
+        """
+        A read-only snapshot of the regions, which supports iteration
+        and intersect_with_box (yielding the same results as here)
+        but lays out the tree for faster queries. Useful after all
+        regions have been added, when many queries are to be made.
+        """
+        return self.tree.freeze()
+
     def intersect_with_line(self, a, v, positive=True):
         """
         Yield regions whose extents overlap with the line a+rv. If
@@ -163,3 +192,13 @@ class BlobOctree(object):
         """
         print(f"Octree with bounds {self.bounds}:")
         self.tree.debug_description(1)
+
+
+def blob_octree_from_list(bounds, l):
+    """
+    Constructs a blob octree from a list l of triples (p, b, d), as
+    taken by BlobOctree.insert.
+    """
+    o = BlobOctree(bounds)
+    o.extend(l)
+    return o
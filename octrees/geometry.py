@@ -21,7 +21,7 @@ Some supporting 3D geometric code
 (C) James Cranch 2013--2021
 """
 
-from math import sqrt
+from math import hypot, inf
 
 
 def bounding(x, e):
@@ -46,7 +46,7 @@ def agreement(g):
 def centroid(b):
     "The centroid of box b"
     ((minx, maxx), (miny, maxy), (minz, maxz)) = b
-    return ((minx+maxx)/2, (miny+maxy)/2, (minz+maxz)/2)
+    return ((minx+maxx)*0.5, (miny+maxy)*0.5, (minz+maxz)*0.5)
 
 
 def box_volume(b):
@@ -80,6 +80,52 @@ def boxes_disjoint(b1, b2):
             or maxz2 <= minz1 or maxz1 <= minz2)
 
 
+def box_relation(b1, b2):
+    """
+    Combines box_contains and boxes_disjoint: returns True if all of
+    b1 is in b2, False if b1 and b2 are disjoint, and None otherwise.
+    """
+    return box_relation_flat(flatten_box(b1), flatten_box(b2))
+
+
+def flatten_box(b):
+    """
+    The flat form (minx, maxx, miny, maxy, minz, maxz) of a box b,
+    used internally where boxes are compared very often.
+    """
+    ((minx, maxx), (miny, maxy), (minz, maxz)) = b
+    return (minx, maxx, miny, maxy, minz, maxz)
+
+
+def unflatten_box(e):
+    "The usual form of a box e given in flat form"
+    (minx, maxx, miny, maxy, minz, maxz) = e
+    return ((minx, maxx), (miny, maxy), (minz, maxz))
+
+
+def boxes_disjoint_flat(e1, e2):
+    "As boxes_disjoint, for boxes in flat form"
+    return (e2[1] <= e1[0] or e1[1] <= e2[0]
+            or e2[3] <= e1[2] or e1[3] <= e2[2]
+            or e2[5] <= e1[4] or e1[5] <= e2[4])
+
+
+def box_relation_flat(e1, e2):
+    "As box_relation, for boxes in flat form"
+    (minx1, maxx1, miny1, maxy1, minz1, maxz1) = e1
+    (minx2, maxx2, miny2, maxy2, minz2, maxz2) = e2
+    if (maxx2 <= minx1 or maxx1 <= minx2
+            or maxy2 <= miny1 or maxy1 <= miny2
+            or maxz2 <= minz1 or maxz1 <= minz2):
+        return False
+    elif (minx2 <= minx1 and maxx1 <= maxx2
+          and miny2 <= miny1 and maxy1 <= maxy2
+          and minz2 <= minz1 and maxz1 <= maxz2):
+        return True
+    else:
+        return None
+
+
 def union_box(b1, b2):
     "The smallest box containing b1 and b2"
     ((minx1, maxx1), (miny1, maxy1), (minz1, maxz1)) = b1
@@ -91,110 +137,180 @@ def union_box(b1, b2):
 
 def vertices(bounds):
     "The vertices of a box"
-    (xs, ys, zs) = bounds
-    for x in xs:
-        for y in ys:
-            for z in zs:
-                yield (x, y, z)
+    ((x0, x1), (y0, y1), (z0, z1)) = bounds
+    return ((x0, y0, z0), (x0, y0, z1), (x0, y1, z0), (x0, y1, z1),
+            (x1, y0, z0), (x1, y0, z1), (x1, y1, z0), (x1, y1, z1))
 
 
 def subboxes(bounds):
     "The eight boxes contained within a box"
     ((minx, maxx), (miny, maxy), (minz, maxz)) = bounds
-    (midx,midy,midz) = centroid(bounds)
-    for bx in [(minx, midx), (midx, maxx)]:
-        for by in [(miny, midy), (midy, maxy)]:
-            for bz in [(minz, midz), (midz, maxz)]:
-                yield (bx, by, bz)
+    midx = (minx+maxx)*0.5
+    midy = (miny+maxy)*0.5
+    midz = (minz+maxz)*0.5
+    (x0, x1) = ((minx, midx), (midx, maxx))
+    (y0, y1) = ((miny, midy), (midy, maxy))
+    (z0, z1) = ((minz, midz), (midz, maxz))
+    return ((x0, y0, z0), (x0, y0, z1), (x0, y1, z0), (x0, y1, z1),
+            (x1, y0, z0), (x1, y0, z1), (x1, y1, z0), (x1, y1, z1))
 
 
 def narrow(bounds, coords):
     "Narrow down a box to an appropriate subbox"
 
     ((minx, maxx), (miny, maxy), (minz, maxz)) = bounds
-    (midx,midy,midz) = centroid(bounds)
+    midx = (minx+maxx)*0.5
+    midy = (miny+maxy)*0.5
+    midz = (minz+maxz)*0.5
 
     (x, y, z) = coords
-    n = 0
-
-    if x < midx:
-        newx = (minx, midx)
-    else:
-        n += 4
-        newx = (midx, maxx)
-    if y < midy:
-        newy = (miny, midy)
-    else:
-        n += 2
-        newy = (midy, maxy)
-    if z < midz:
-        newz = (minz, midz)
-    else:
-        n += 1
-        newz = (midz, maxz)
+    bx = x >= midx
+    by = y >= midy
+    bz = z >= midz
 
-    return (n, (newx, newy, newz))
+    return ((bx << 2) | (by << 1) | bz,
+            ((midx, maxx) if bx else (minx, midx),
+             (midy, maxy) if by else (miny, midy),
+             (midz, maxz) if bz else (minz, midz)))
 
 
 def euclidean_point_point(p, q):
     "The euclidean distance between points p and q"
     (x1, y1, z1) = p
     (x2, y2, z2) = q
-    return sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
+    return hypot(x1-x2, y1-y2, z1-z2)
+
+
+def euclidean_point_points(p, l):
+    """
+    The euclidean distances from p to each of the points in l, as a
+    list. Gives the same results as euclidean_point_point, but saves
+    a function call per point.
+    """
+    (x1, y1, z1) = p
+    return [hypot(x1-x2, y1-y2, z1-z2)
+            for (x2, y2, z2) in l]
 
 
 def nearest_point_in_box(p, b):
     "Returns the nearest point in a box b to a point p"
     ((minx, maxx), (miny, maxy), (minz, maxz)) = b
     (x, y, z) = p
-    if x < minx:
-        x0 = minx
-    elif x < maxx:
-        x0 = x
-    else:
-        x0 = maxx
-    if y < miny:
-        y0 = miny
-    elif y < maxy:
-        y0 = y
-    else:
-        y0 = maxy
-    if z < minz:
-        z0 = minz
-    elif z < maxz:
-        z0 = z
-    else:
-        z0 = maxz
-    return (x0, y0, z0)
+    return (min(max(x, minx), maxx),
+            min(max(y, miny), maxy),
+            min(max(z, minz), maxz))
 
 
 def furthest_point_in_box(p, b):
     "Returns the furthest point in a box b to a point p"
     ((minx, maxx), (miny, maxy), (minz, maxz)) = b
     (x, y, z) = p
-    if 2*x > minx+maxx:
-        x0 = minx
-    else:
-        x0 = maxx
-    if 2*y > miny+maxy:
-        y0 = miny
-    else:
-        y0 = maxy
-    if 2*z > minz+maxz:
-        z0 = minz
-    else:
-        z0 = maxz
-    return (x0, y0, z0)
+    return (minx if 2*x > minx+maxx else maxx,
+            miny if 2*y > miny+maxy else maxy,
+            minz if 2*z > minz+maxz else maxz)
 
 
 def euclidean_point_box(p, b):
     "The euclidean distance between p and a box b"
-    return euclidean_point_point(p, nearest_point_in_box(p, b))
+    ((minx, maxx), (miny, maxy), (minz, maxz)) = b
+    (x, y, z) = p
+    dx = minx-x if x < minx else (x-maxx if maxx < x else 0)
+    dy = miny-y if y < miny else (y-maxy if maxy < y else 0)
+    dz = minz-z if z < minz else (z-maxz if maxz < z else 0)
+    return hypot(dx, dy, dz)
 
 
 def euclidean_point_box_max(p, b):
     "The furthest distance between p and a box b"
-    return euclidean_point_point(p, furthest_point_in_box(p, b))
+    ((minx, maxx), (miny, maxy), (minz, maxz)) = b
+    (x, y, z) = p
+    dx = max(x-minx, maxx-x)
+    dy = max(y-miny, maxy-y)
+    dz = max(z-minz, maxz-z)
+    return hypot(dx, dy, dz)
+
+
+def distance_functions(p, epsilon=None):
+    """
+    Returns a pair of functions, giving the euclidean distance from p
+    to a point and to a box respectively. If epsilon is given, they
+    return None for distances exceeding it (as with bounding).
+
+    These are the same as euclidean_point_point and
+    euclidean_point_box with p fixed, but avoid an extra function call
+    and unpacking p afresh each time, which matters in searches.
+    """
+    (x1, y1, z1) = p
+
+    if epsilon is None:
+        def point_fn(q):
+            (x2, y2, z2) = q
+            return hypot(x1-x2, y1-y2, z1-z2)
+
+        def box_fn(b):
+            ((minx, maxx), (miny, maxy), (minz, maxz)) = b
+            dx = minx-x1 if x1 < minx else (x1-maxx if maxx < x1 else 0)
+            dy = miny-y1 if y1 < miny else (y1-maxy if maxy < y1 else 0)
+            dz = minz-z1 if z1 < minz else (z1-maxz if maxz < z1 else 0)
+            return hypot(dx, dy, dz)
+
+    else:
+        def point_fn(q):
+            (x2, y2, z2) = q
+            d = hypot(x1-x2, y1-y2, z1-z2)
+            return None if d > epsilon else d
+
+        def box_fn(b):
+            ((minx, maxx), (miny, maxy), (minz, maxz)) = b
+            dx = minx-x1 if x1 < minx else (x1-maxx if maxx < x1 else 0)
+            dy = miny-y1 if y1 < miny else (y1-maxy if maxy < y1 else 0)
+            dz = minz-z1 if z1 < minz else (z1-maxz if maxz < z1 else 0)
+            d = hypot(dx, dy, dz)
+            return None if d > epsilon else d
+
+    return (point_fn, box_fn)
+
+
+def box_distance_functions(b):
+    """
+    Returns a pair of functions, giving the euclidean distance from a
+    point to b and from a box to b respectively.
+
+    As with distance_functions, these agree with euclidean_point_box
+    and euclidean_box_box but unpack b only once.
+    """
+    ((minx, maxx), (miny, maxy), (minz, maxz)) = b
+
+    def point_fn(p):
+        (x, y, z) = p
+        dx = minx-x if x < minx else (x-maxx if maxx < x else 0)
+        dy = miny-y if y < miny else (y-maxy if maxy < y else 0)
+        dz = minz-z if z < minz else (z-maxz if maxz < z else 0)
+        return hypot(dx, dy, dz)
+
+    def box_fn(b1):
+        ((minx1, maxx1), (miny1, maxy1), (minz1, maxz1)) = b1
+        if maxx1 < minx:
+            x = minx - maxx1
+        elif maxx < minx1:
+            x = minx1 - maxx
+        else:
+            x = 0
+        if maxy1 < miny:
+            y = miny - maxy1
+        elif maxy < miny1:
+            y = miny1 - maxy
+        else:
+            y = 0
+        if maxz1 < minz:
+            z = minz - maxz1
+        elif maxz < minz1:
+            z = minz1 - maxz
+        else:
+            z = 0
+        return hypot(x, y, z)
+
+    return (point_fn, box_fn)
 
 
 def euclidean_box_box(b1, b2):
@@ -219,7 +335,7 @@ def euclidean_box_box(b1, b2):
         z = minz1 - maxz2
     else:
         z = 0
-    return sqrt(x*x+y*y+z*z)
+    return hypot(x, y, z)
 
 
 def euclidean_box_box_max(b1, b2):
@@ -229,7 +345,7 @@ def euclidean_box_box_max(b1, b2):
     x = max(maxx2-minx1, maxx1-minx2)
     y = max(maxy2-miny1, maxy1-miny2)
     z = max(maxz2-minz1, maxz1-minz2)
-    return sqrt(x*x+y*y+z*z)
+    return hypot(x, y, z)
 
 
 def euclidean_box_box_minmax(b1, b2):
@@ -246,18 +362,30 @@ def convex_box_deform(f, b):
     Given a function f taking points to points, and a box b, returns
     the box containing f applied to the vertices of b.
     """
-    l = [f(p) for p in vertices(b)]
-    minx = min(q[0] for q in l)
-    maxx = max(q[0] for q in l)
-    miny = min(q[1] for q in l)
-    maxy = max(q[1] for q in l)
-    minz = min(q[2] for q in l)
-    maxz = max(q[2] for q in l)
-    return ((minx, maxx), (miny, maxy), (minz, maxz))
+    (xs, ys, zs) = zip(*[f(p) for p in vertices(b)])
+    return ((min(xs), max(xs)), (min(ys), max(ys)), (min(zs), max(zs)))
 
 
 def matrix_action(m, p):
-    return tuple(sum(m[i][j]*p[j] for j in range(3)) for i in range(3))
+    "The image of the point p under the matrix m"
+    ((a, b, c), (d, e, f), (g, h, i)) = m
+    (x, y, z) = p
+    return (a*x + b*y + c*z, d*x + e*y + f*z, g*x + h*y + i*z)
+
+
+def matrix_box_action(m, b):
+    """
+    The smallest box containing the image of the box b under the
+    matrix m (acting as in matrix_action). The terms are summed in the
+    same order as in matrix_action, so this agrees exactly with
+    applying convex_box_deform to it, but without visiting vertices.
+    """
+    result = []
+    for row in m:
+        ((s0, t0), (s1, t1), (s2, t2)) = [(r*u, r*v) if r >= 0 else (r*v, r*u)
+                                          for (r, (u, v)) in zip(row, b)]
+        result.append((s0 + s1 + s2, t0 + t1 + t2))
+    return tuple(result)
 
 
 def line_segment_intersects_box(p, q, b):
@@ -289,7 +417,6 @@ def line_segment_intersects_box(p, q, b):
     # can trim the line to the box by y coordinate.
     if qy < py:
         (px, py, pz, qx, qy, qz) = (qx, qy, qz, px, py, pz)
-        print(f"swapping; p = {(px, py, pz)}, q = {(qx, qy, qz)}")
     if qy < miny or maxy < py:
         return False
     if py < miny:
@@ -316,41 +443,132 @@ def line_intersects_box(a, v, b):
     """
     Does the line a+rv meet the box b?
     """
-    mins = []
-    maxs = []
-    for (ac, vc, ec) in zip(a, v, b):
-        ec1, ec2 = ec
+    return line_intersects_box_flat(a, v, flatten_box(b))
+
+
+def line_intersects_box_flat(a, v, e):
+    "As line_intersects_box, for a box in flat form"
+    (ax, ay, az) = a
+    (vx, vy, vz) = v
+    (minx, maxx, miny, maxy, minz, maxz) = e
+    rmin = float("-inf")
+    rmax = float("inf")
+    for (ac, vc, ec1, ec2) in ((ax, vx, minx, maxx),
+                               (ay, vy, miny, maxy),
+                               (az, vz, minz, maxz)):
         if vc == 0:
             if not(min(ec1, ec2) <= ac <= max(ec1, ec2)):
                 return False
-        else:
-            r, s = (ec1-ac)/vc, (ec2-ac)/vc
-            mins.append(min(r, s))
-            maxs.append(max(r, s))
-    return max(mins) <= min(maxs)
+            continue
+        r, s = (ec1-ac)/vc, (ec2-ac)/vc
+        if s < r:
+            r, s = s, r
+        if r > rmin:
+            rmin = r
+        if s < rmax:
+            rmax = s
+        if rmax < rmin:
+            return False
+    return True
 
 
 def halfline_intersects_box(a, v, b):
     """
     Does the halfline a+rv with r positive meet the box b?
     """
-    mins = []
-    maxs = []
-    for (ac, vc, ec) in zip(a, v, b):
-        ec1, ec2 = ec
+    return halfline_intersects_box_flat(a, v, flatten_box(b))
+
+
+def halfline_intersects_box_flat(a, v, e):
+    "As halfline_intersects_box, for a box in flat form"
+    (ax, ay, az) = a
+    (vx, vy, vz) = v
+    (minx, maxx, miny, maxy, minz, maxz) = e
+    rmin = 0
+    rmax = float("inf")
+    for (ac, vc, ec1, ec2) in ((ax, vx, minx, maxx),
+                               (ay, vy, miny, maxy),
+                               (az, vz, minz, maxz)):
         if vc == 0:
             if not(min(ec1, ec2) <= ac <= max(ec1, ec2)):
                 return False
-        else:
-            r, s = (ec1-ac)/vc, (ec2-ac)/vc
-            mins.append(min(r, s))
-            maxs.append(max(r, s))
-    return max(mins) <= min(maxs) and 0 <= min(maxs)
+            continue
+        r, s = (ec1-ac)/vc, (ec2-ac)/vc
+        if s < r:
+            r, s = s, r
+        if r > rmin:
+            rmin = r
+        if s < rmax:
+            rmax = s
+        if rmax < rmin:
+            return False
+    return True
+
+
+def line_intersection_function(a, v, positive=False):
+    """
+    Returns a function which, given a box in flat form, says whether
+    the line a+rv meets it (or, if positive is true, whether the
+    halfline with r positive does). The reciprocals of the components
+    of v are worked out once here, so that each test multiplies
+    rather than divides (except where a component is so small that
+    its reciprocal overflows).
+    """
+    (ax, ay, az) = a
+    (vx, vy, vz) = v
+    (ix, iy, iz) = (None if vc == 0 or abs(1.0/vc) == inf else 1.0/vc
+                    for vc in v)
+    start = 0 if positive else -inf
+    end = inf
+
+    def intersects(e):
+        (minx, maxx, miny, maxy, minz, maxz) = e
+        rmin = start
+        rmax = end
+        for (ac, vc, ic, ec1, ec2) in ((ax, vx, ix, minx, maxx),
+                                       (ay, vy, iy, miny, maxy),
+                                       (az, vz, iz, minz, maxz)):
+            if ic is not None:
+                r, s = (ec1-ac)*ic, (ec2-ac)*ic
+            elif vc == 0:
+                if not(ec1 <= ac <= ec2):
+                    return False
+                continue
+            else:
+                r, s = (ec1-ac)/vc, (ec2-ac)/vc
+            if s < r:
+                r, s = s, r
+            if r > rmin:
+                rmin = r
+            if s < rmax:
+                rmax = s
+            if rmax < rmin:
+                return False
+        return True
+
+    return intersects
 
 
 def box_intersects_plane(b, f):
     """
     Does the box b intersect the plane defined by f(x)=0?
     """
-    return (any(f(p) >= 0 for p in vertices(b))
-            and any(f(q) <= 0 for q in vertices(b)))
+    return box_intersects_plane_flat(flatten_box(b), f)
+
+
+def box_intersects_plane_flat(e, f):
+    "As box_intersects_plane, for a box in flat form"
+    (minx, maxx, miny, maxy, minz, maxz) = e
+    pos = False
+    neg = False
+    for x in (minx, maxx):
+        for y in (miny, maxy):
+            for z in (minz, maxz):
+                v = f((x, y, z))
+                if v >= 0:
+                    pos = True
+                if v <= 0:
+                    neg = True
+                if pos and neg:
+                    return True
+    return False
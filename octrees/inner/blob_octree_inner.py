@@ -37,42 +37,30 @@ from octrees.inner.octree_inner import *
 
 class BlobTree(Tree):
 
+    __slots__ = ()
+
     def extent(self):
         """
         Returns the bounds ((minx, maxx), (miny, maxy), (minz, maxz)).
+
+        Internally, extents are stored in the flat form (minx, maxx,
+        miny, maxy, minz, maxz) as cached_extent; this is also the
+        form passed to the point_fn and box_fn of subset_by_extent
+        and iter_by_extent.
         """
         raise NotImplementedError
 
     def intersection_with_box(self, b):
-
-        def point_fn(e):
-            return not boxes_disjoint(e, b)
-
-        def box_fn(e):
-            if boxes_disjoint(e, b):
-                return False
-            if box_contains(e, b):
-                return True
-            return None
-
-        return self.subset_by_extent(point_fn, box_fn)
+        """
+        The subtree of regions whose extents overlap with b.
+        """
+        return self.subset_by_box(flatten_box(b))
 
     def intersect_with_box(self, b):
         """
         Yield regions whose extents overlap with b.
         """
-        def point_fn(e):
-            return not boxes_disjoint(e, b)
-
-        def box_fn(e):
-            if boxes_disjoint(e, b):
-                return False
-            if box_contains(e, b):
-                return True
-            return None
-
-        for t in self.iter_by_extent(point_fn, box_fn):
-            yield t
+        return self.iter_by_box(flatten_box(b))
 
     def intersect_with_line(self, a, v, positive=True):
         """
@@ -81,11 +69,7 @@ class BlobTree(Tree):
         intersecting with a halfline).
         """
 
-        def point_fn(e):
-            if positive:
-                return halfline_intersects_box(a, v, e)
-            else:
-                return line_intersects_box(a, v, e)
+        point_fn = line_intersection_function(a, v, positive)
 
         def box_fn(e):
             return (point_fn(e) and None)
@@ -99,7 +83,7 @@ class BlobTree(Tree):
         """
 
         def point_fn(e):
-            return line_segment_intersects_box(a, b, e)
+            return line_segment_intersects_box(a, b, unflatten_box(e))
 
         def box_fn(e):
             return (point_fn(e) and None)
@@ -116,16 +100,26 @@ class BlobTree(Tree):
         """
 
         def point_fn(e):
-            return box_intersects_plane(e, f)
+            return box_intersects_plane_flat(e, f)
 
         def box_fn(e):
-            return box_intersects_plane(e, f) and None
+            return box_intersects_plane_flat(e, f) and None
 
         return self.iter_by_extent(point_fn, box_fn)
 
+    def freeze(self):
+        """
+        A read-only copy of self, for fast box queries.
+        """
+        return FrozenBlobTree(self)
+
 
 class BlobEmpty(BlobTree, Empty):
 
+    __slots__ = ()
+
+    cached_extent = None
+
     def extent(self):
         return None
 
@@ -133,55 +127,70 @@ class BlobEmpty(BlobTree, Empty):
         return self
 
     def iter_by_extent(self, point_fn, box_fn):
-        return
-        yield
+        return iter(())
 
-    def reroot(self):
+    def subset_by_box(self, b):
         return self
 
+    def iter_by_box(self, b):
+        return iter(())
+
     def possible_overlaps(self, other):
-        return
-        yield
+        return iter(())
 
     def by_possible_overlap(self, other):
-        return
-        yield
+        return iter(())
 
     def debug_description(self, indent):
         print("  "*indent + "Empty")
 
-BlobTree.empty = BlobEmpty
+_BLOB_EMPTY = BlobEmpty()
+BlobTree.empty = staticmethod(lambda: _BLOB_EMPTY)
 
 
 class BlobSingleton(BlobTree, Singleton):
 
+    __slots__ = ('cached_extent', 'cached_triple')
+
+    def __init__(self, coords, data):
+        Singleton.__init__(self, coords, data)
+        self.cached_extent = flatten_box(data[0])
+        self.cached_triple = (coords, data[0], data[1])
+
     def data_triple(self):
-        return (self.coords, self.data[0], self.data[1])
+        return self.cached_triple
 
     def extent(self):
         return self.data[0]
 
     def subset_by_extent(self, point_fn, box_fn):
-        if point_fn(self.extent()):
+        if point_fn(self.cached_extent):
             return self
         else:
             return self.empty()
 
     def iter_by_extent(self, point_fn, box_fn):
-        if point_fn(self.extent()):
-            yield self.data_triple()
+        if point_fn(self.cached_extent):
+            yield self.cached_triple
 
-    def reroot(self):
-        return self
+    def subset_by_box(self, b):
+        if boxes_disjoint_flat(self.cached_extent, b):
+            return self.empty()
+        else:
+            return self
+
+    def iter_by_box(self, b):
+        if not boxes_disjoint_flat(self.cached_extent, b):
+            yield self.cached_triple
 
     def possible_overlaps(self, other):
-        t1 = self.data_triple()
-        for t2 in other.intersect_with_box(self.extent()):
+        t1 = self.cached_triple
+        for t2 in other.iter_by_box(self.cached_extent):
             yield (t1, t2)
 
     def by_possible_overlap(self, other):
-        e = self.data[0]
-        yield (self.data_triple(), list(other.intersect_with_box(e)))
+        e = self.cached_extent
+        yield (self.cached_triple, list(other.iter_by_box(e)))
 
     def debug_description(self, indent):
         s = "Singleton at %s with bounds %s and data %s" % (
@@ -193,74 +202,204 @@ BlobTree.singleton = BlobSingleton
 
 class BlobNode(BlobTree, Node):
 
+    __slots__ = ('cached_extent', 'child_extents')
+
     def __init__(self, content=None):
         Node.__init__(self, content)
 
-        l = [a.extent() for a in self.content]
-        l = [a for a in l if a is not None]
-        if len(l) == 0:
-            e = None
-        else:
-            e = ((min(a[0][0] for a in l),
-                  max(a[0][1] for a in l)),
-                 (min(a[1][0] for a in l),
-                  max(a[1][1] for a in l)),
-                 (min(a[2][0] for a in l),
-                  max(a[2][1] for a in l)))
+        self.child_extents = l = tuple([a.cached_extent
+                                        for a in self.content])
+
+        # A single pass in Python, keeping running minima and maxima,
+        # is faster for eight children than anything vectorised
+        e = None
+        n = 0
+        for a in l:
+            if a is None:
+                continue
+            n += 1
+            if e is None:
+                (minx, maxx, miny, maxy, minz, maxz) = e = a
+                continue
+            (minx1, maxx1, miny1, maxy1, minz1, maxz1) = a
+            if minx1 < minx:
+                minx = minx1
+            if maxx1 > maxx:
+                maxx = maxx1
+            if miny1 < miny:
+                miny = miny1
+            if maxy1 > maxy:
+                maxy = maxy1
+            if minz1 < minz:
+                minz = minz1
+            if maxz1 > maxz:
+                maxz = maxz1
+        if n > 1:
+            e = (minx, maxx, miny, maxy, minz, maxz)
         self.cached_extent = e
 
     def extent(self):
-        return self.cached_extent
+        if self.cached_extent is None:
+            return None
+        else:
+            return unflatten_box(self.cached_extent)
 
     def subset_by_extent(self, point_fn, box_fn):
-        a = box_fn(self.extent())
+        a = box_fn(self.cached_extent)
         if a is None:
-            return self.smartnode([t.subset_by_extent(point_fn, box_fn)
-                                   for t in self.content])
+            # Deal with empty and singleton children directly, only
+            # recursing into nodes
+            l = []
+            for (t, e) in zip(self.content, self.child_extents):
+                if isinstance(t, BlobNode):
+                    l.append(t.subset_by_extent(point_fn, box_fn))
+                elif e is None or point_fn(e):
+                    l.append(t)
+                else:
+                    l.append(self.empty())
+            return self.smartnode(l)
         elif a:
             return self
         else:
             return self.empty()
 
     def iter_by_extent(self, point_fn, box_fn):
-        a = box_fn(self.extent())
-        if a is None:
-            for t in self.content:
-                for r in t.iter_by_extent(point_fn, box_fn):
-                    yield r
-        elif a:
-            for (p, (b, d)) in self:
-                yield (p, b, d)
+        # As in iter_by_box, empty and singleton children are dealt
+        # with directly and nodes are put on a stack to visit later
+        stack = [self]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            n = pop()
+            a = box_fn(n.cached_extent)
+            if a is None:
+                for (t, e) in zip(n.content, n.child_extents):
+                    if e is None:
+                        continue
+                    elif isinstance(t, BlobNode):
+                        push(t)
+                    elif point_fn(e):
+                        yield t.cached_triple
+            elif a:
+                for (p, (b, d)) in n:
+                    yield (p, b, d)
+
+    def subset_by_box(self, b):
+        """
+        Specialised version of subset_by_extent for intersecting with
+        a box: each child is classified against b using the extents
+        cached on this node, so we only recurse into children which
+        partially overlap b.
+        """
+        l = []
+        for (t, e) in zip(self.content, self.child_extents):
+            if e is None:
+                l.append(t)
+                continue
+            a = box_relation_flat(e, b)
+            if a is None:
+                l.append(t.subset_by_box(b))
+            elif a:
+                l.append(t)
+            else:
+                l.append(self.empty())
+        return self.smartnode(l)
 
-    def reroot(self):
+    def iter_by_box(self, b):
         """
-        Discards unnecessary tree data at the root, at the cost of
-        losing track of anything we knew about bounds.
+        Specialised version of iter_by_extent for intersecting with
+        a box; see subset_by_box.
 
-        Useful in a couple of algorithms.
+        Uses an explicit stack of nodes still to visit, rather than
+        recursing, so that yielded results are not passed up through
+        a chain of generators.
         """
-        l = list(self.content)
-        s = sum(isinstance(x, BlobEmpty) for x in l)
-        if s == 7:
-            for x in l:
-                if not isinstance(x, BlobEmpty):
-                    return x.reroot()
-        else:
-            return self
+        relation = box_relation_flat
+        stack = [self]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            n = pop()
+            for (t, e) in zip(n.content, n.child_extents):
+                if e is None:
+                    continue
+                a = relation(e, b)
+                if a is None:
+                    if isinstance(t, BlobNode):
+                        push(t)
+                    else:
+                        yield t.cached_triple
+                elif a:
+                    for (p, (c, d)) in t:
+                        yield (p, c, d)
 
     def possible_overlaps(self, other):
-        o = other.intersection_with_box(self.extent()).reroot()
-        for s in self.content:
-            for x in s.possible_overlaps(o):
-                yield x
+        """
+        Descends through self and other together, only considering
+        pairs of children whose extents overlap. As in iter_by_box,
+        the pairs still to visit are kept on an explicit stack.
+        """
+        disjoint = boxes_disjoint_flat
+        stack = [(self, other)]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            (s, t) = pop()
+            if isinstance(s, BlobSingleton):
+                for x in s.possible_overlaps(t):
+                    yield x
+            elif isinstance(t, BlobNode):
+                l = [(t1, e2)
+                     for (t1, e2) in zip(t.content, t.child_extents)
+                     if e2 is not None]
+                for (s1, e1) in zip(s.content, s.child_extents):
+                    if e1 is None:
+                        continue
+                    for (t1, e2) in l:
+                        if not disjoint(e1, e2):
+                            push((s1, t1))
+            elif isinstance(t, BlobSingleton):
+                t2 = t.cached_triple
+                for t1 in s.iter_by_box(t.cached_extent):
+                    yield (t1, t2)
 
     def by_possible_overlap(self, other):
-        for s in self.content:
-            e = s.extent()
-            if e is not None:
-                a = other.intersection_with_box(e).reroot()
-                for x in s.by_possible_overlap(a):
-                    yield x
+        """
+        Descends through self, carrying along a list of the parts of
+        other which may overlap the current node. At each step that
+        list is narrowed down, opening up nodes of other by one
+        level, so no pruned copies of other need to be built.
+        """
+        disjoint = boxes_disjoint_flat
+        stack = [(self, [other])]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            (s, l) = pop()
+            for (t, e) in zip(s.content, s.child_extents):
+                if e is None:
+                    continue
+                m = []
+                for x in l:
+                    ex = x.cached_extent
+                    if ex is None or disjoint(ex, e):
+                        continue
+                    if isinstance(x, BlobNode):
+                        for (y, ey) in zip(x.content, x.child_extents):
+                            if ey is not None and not disjoint(ey, e):
+                                m.append(y)
+                    else:
+                        m.append(x)
+                if isinstance(t, BlobNode):
+                    push((t, m))
+                else:
+                    r = []
+                    for x in m:
+                        if isinstance(x, BlobNode):
+                            r.extend(x.iter_by_box(e))
+                        else:
+                            r.append(x.cached_triple)
+                    yield (t.cached_triple, r)
 
     def debug_description(self, indent):
         print("  "*indent + f"Node with extent {self.extent()}:")
@@ -268,3 +407,72 @@ class BlobNode(BlobTree, Node):
             s.debug_description(indent+1)
 
 BlobTree.node = BlobNode
+BlobNode.empty_content = (_BLOB_EMPTY,)*8
+
+
+class FrozenBlobTree(object):
+    """
+    A read-only copy of a blob tree, laid out for fast box queries.
+
+    The nodes and singletons are listed in depth-first order, with
+    their extents, the data triple (for singletons; None for nodes),
+    and the position just after the end of their subtree. A query is
+    then a single walk along these lists, jumping over subtrees which
+    need not be looked at, with no recursion or stack.
+    """
+
+    __slots__ = ('extents', 'triples', 'skips')
+
+    def __init__(self, tree):
+        self.extents = []
+        self.triples = []
+        self.skips = []
+        self._add(tree)
+
+    def _add(self, tree):
+        if tree.cached_extent is None:
+            return
+        i = len(self.extents)
+        self.extents.append(tree.cached_extent)
+        self.skips.append(None)
+        if isinstance(tree, BlobNode):
+            self.triples.append(None)
+            for t in tree.content:
+                self._add(t)
+        else:
+            self.triples.append(tree.cached_triple)
+        self.skips[i] = len(self.extents)
+
+    def __len__(self):
+        return len(self.triples) - self.triples.count(None)
+
+    def __iter__(self):
+        for t in self.triples:
+            if t is not None:
+                yield t
+
+    def intersect_with_box(self, b):
+        """
+        Yield regions whose extents overlap with b.
+        """
+        b = flatten_box(b)
+        relation = box_relation_flat
+        extents = self.extents
+        triples = self.triples
+        skips = self.skips
+        i = 0
+        n = len(extents)
+        while i < n:
+            a = relation(extents[i], b)
+            if a is None:
+                t = triples[i]
+                if t is not None:
+                    yield t
+                i += 1
+            elif a:
+                for t in triples[i:skips[i]]:
+                    if t is not None:
+                        yield t
+                i = skips[i]
+            else:
+                i = skips[i]
@@ -29,15 +29,19 @@ directly.
 (C) James Cranch 2013--2021
 """
 
-from functools import reduce
 import heapq
 
 from octrees.geometry import *
-from octrees.inner.misc import pivot
 
 
 class Tree(object):
 
+    __slots__ = ()
+
+    # Subclasses set _kind to 0 (empty), 1 (singleton) or 2 (node);
+    # comparing it is cheaper than isinstance in the hot loops
+    _kind = None
+
     def smartnode(self, data):
         """
         Assembles the given octants into a node.
@@ -48,9 +52,10 @@ class Tree(object):
             data = [a, b, c, d, e, f, g, h]
         singleton = None
         for x in data:
-            if isinstance(x, Node):
+            k = x._kind
+            if k == 2:
                 return self.node(data)
-            elif isinstance(x, Singleton):
+            elif k == 1:
                 if singleton is not None:
                     return self.node(data)
                 else:
@@ -63,12 +68,16 @@ class Tree(object):
 
 class Empty(Tree):
 
+    __slots__ = ()
+
+    _kind = 0
+    cached_length = 0
+
     def __init__(self):
         pass
 
     def __iter__(self):
-        return
-        yield
+        return iter(())
 
     def __len__(self):
         return 0
@@ -94,9 +103,6 @@ class Empty(Tree):
     def subset(self, bounds, point_fn, box_fn):
         return self
 
-    def enqueue(self, heap, bounds, pointscore, boxscore):
-        pass
-
     def union(self, other, bounds, swapped=False):
         return other
 
@@ -106,11 +112,18 @@ class Empty(Tree):
     def deform(self, oldbounds, newbounds, point_fn, box_fn):
         return self
 
-Tree.empty = Empty
+# Empty trees have no state, so we share a single one
+_EMPTY = Empty()
+Tree.empty = staticmethod(lambda: _EMPTY)
 
 
 class Singleton(Tree):
 
+    __slots__ = ('coords', 'data')
+
+    _kind = 1
+    cached_length = 1
+
     def __init__(self, coords, data):
         self.coords = coords
         self.data = data
@@ -164,11 +177,6 @@ class Singleton(Tree):
         else:
             return self.empty()
 
-    def enqueue(self, heap, bounds, pointscore, boxscore):
-        s = pointscore(self.coords)
-        if s is not None:
-            heapq.heappush(heap, (s, False, self.coords, self.data))
-
     def union(self, other, bounds, swapped=False):
         return other.update(bounds, self.coords, self.data, replace=swapped)
 
@@ -190,32 +198,49 @@ Tree.singleton = Singleton
 
 class Node(Tree):
 
+    __slots__ = ('content', 'cached_length')
+
+    _kind = 2
+
     def __init__(self, content=None):
         """
         Takes either a generator of eight octrees, or generators of two
         nested three deep (or None for an empty octree).
         """
         if content is None:
-            content = (self.empty(),)*8
-        else:
+            content = self.empty_content
+        elif type(content) is not tuple or len(content) != 8:
             content = tuple(content)
             if len(content) == 2:
-                content = tuple(x for x in b for b in a for a in content)
+                content = tuple(x for a in content for b in a for x in b)
             if len(content) != 8:
                 raise ValueError("Content in unrecognised format")
         self.content = content
+        self.cached_length = sum([x.cached_length for x in content])
 
     def __len__(self):
-        return sum(len(x) for x in self.content)
+        return self.cached_length
 
     def __iter__(self):
-        for x in self.content:
-            for t in iter(x):
-                yield t
+        # Uses a stack of iterators over nodes' contents, rather than
+        # recursing, to avoid passing each point up through a chain
+        # of generators
+        stack = [iter(self.content)]
+        while stack:
+            for x in stack[-1]:
+                k = x._kind
+                if k == 2:
+                    stack.append(iter(x.content))
+                    break
+                elif k == 1:
+                    yield (x.coords, x.data)
+            else:
+                stack.pop()
 
     def __eq__(self, other):
         if isinstance(other, Node):
-            return self.content == other.content
+            return (self.cached_length == other.cached_length
+                    and self.content == other.content)
         else:
             return False
 
@@ -227,22 +252,25 @@ class Node(Tree):
         return self.content[n].get(newbounds, coords, default)
 
     def insert(self, bounds, coords, data):
+        # Copying into a list, replacing and converting back is faster
+        # than splicing tuple slices together; handing Node a tuple
+        # lets it skip normalising the content
         a = list(self.content)
         (n, newbounds) = narrow(bounds, coords)
         a[n] = a[n].insert(newbounds, coords, data)
-        return self.node(a)
+        return self.node(tuple(a))
 
     def update(self, bounds, coords, data, replace=True):
         a = list(self.content)
         (n, newbounds) = narrow(bounds, coords)
         a[n] = a[n].update(newbounds, coords, data, replace=replace)
-        return self.node(a)
+        return self.node(tuple(a))
 
     def remove(self, bounds, coords):
         a = list(self.content)
         (n, newbounds) = narrow(bounds, coords)
         a[n] = a[n].remove(newbounds, coords)
-        return self.smartnode(a)
+        return self.smartnode(tuple(a))
 
     def children(self, bounds):
         return zip(subboxes(bounds), self.content)
@@ -250,18 +278,13 @@ class Node(Tree):
     def subset(self, bounds, point_fn, box_fn):
         x = box_fn(bounds)
         if x is None:
-            return self.smartnode(list(t.subset(b, point_fn, box_fn)
-                                       for (b, t) in self.children(bounds)))
+            return self.smartnode([t.subset(b, point_fn, box_fn)
+                                   for (b, t) in self.children(bounds)])
         elif x:
             return self
         else:
             return self.empty()
 
-    def enqueue(self, heap, bounds, pointscore, boxscore):
-        s = boxscore(bounds)
-        if s is not None:
-            heapq.heappush(heap, (s, True, bounds, self))
-
     def union(self, other, bounds, swapped=False):
         if not isinstance(other, Node):
             return other.union(self, bounds, not swapped)
@@ -280,9 +303,12 @@ class Node(Tree):
         elif boxes_disjoint(oldbounds, newbounds):
             return self.empty()
         else:
-            return reduce(lambda x, y: x.union(y, newbounds),
-                          (x.rebound(b, newbounds)
-                           for (b, x) in self.children(oldbounds)))
+            acc = None
+            for (b, x) in self.children(oldbounds):
+                r = x.rebound(b, newbounds)
+                if r.cached_length:
+                    acc = r if acc is None else acc.union(r, newbounds)
+            return self.empty() if acc is None else acc
 
     def deform(self, oldbounds, newbounds, point_fn, box_fn):
         if box_contains(oldbounds, newbounds):
@@ -291,30 +317,135 @@ class Node(Tree):
         elif boxes_disjoint(box_fn(oldbounds), newbounds):
             return self.empty()
         else:
-            return reduce(lambda x, y: x.union(y, newbounds),
-                          (x.deform(b, newbounds, point_fn, box_fn)
-                           for (b, x) in self.children(oldbounds)))
+            acc = None
+            for (b, x) in self.children(oldbounds):
+                r = x.deform(b, newbounds, point_fn, box_fn)
+                if r.cached_length:
+                    acc = r if acc is None else acc.union(r, newbounds)
+            return self.empty() if acc is None else acc
 
 Tree.node = Node
+Node.empty_content = (_EMPTY,)*8
+
 
+def octree_from_list_inner(bounds, l, start, stop, tree=Tree):
+    """
+    Builds a tree from the (coords, data) pairs in l[start:stop],
+    reordering that part of l in doing so.
 
-def octree_from_list_inner(bounds, l, start, stop):
+    The classes used are those of tree (so passing BlobTree builds a
+    blob tree). Raises KeyError if two points have the same
+    coordinates.
+    """
     if start == stop:
-        return Empty()
+        return tree.empty()
     elif start+1 == stop:
         (p,d) = l[start]
-        return Singleton(p,d)
+        return tree.singleton(p,d)
     else:
-        (midx, midy, midz) = centroid(bounds)
-        n4 = pivot(l, lambda t: t[0][0]<midx, start, stop)
-        n2 = pivot(l, lambda t: t[0][1]<midy, start, n4)
-        n6 = pivot(l, lambda t: t[0][1]<midy, n4, stop)
-        n1 = pivot(l, lambda t: t[0][2]<midz, start, n2)
-        n3 = pivot(l, lambda t: t[0][2]<midz, n2, n4)
-        n5 = pivot(l, lambda t: t[0][2]<midz, n4, n6)
-        n7 = pivot(l, lambda t: t[0][2]<midz, n6, stop)
-        return Node([octree_from_list_inner(b, l, r, s)
-                     for (b,r,s) in zip(
-                             subboxes(bounds),
-                             [start, n1, n2, n3, n4, n5, n6, n7],
-                             [n1, n2, n3, n4, n5, n6, n7, stop])])
+        # Sort l[start:stop] by octant in a single pass, rather than
+        # partitioning it seven times
+        boxes = subboxes(bounds)
+        ((_, midx), (_, midy), (_, midz)) = boxes[0]
+        buckets = ([], [], [], [], [], [], [], [])
+        for i in range(start, stop):
+            t = l[i]
+            (x, y, z) = t[0]
+            buckets[((x >= midx) << 2) | ((y >= midy) << 1)
+                    | (z >= midz)].append(t)
+        starts = []
+        i = start
+        for b in buckets:
+            starts.append(i)
+            l[i:i+len(b)] = b
+            i += len(b)
+        stops = starts[1:] + [stop]
+        if any(len(b) == stop-start for b in buckets):
+            # Everything landed in the same octant; if that's because
+            # the points coincide, we would otherwise never finish
+            p = l[start][0]
+            if all(t[0] == p for t in l[start+1:stop]):
+                raise KeyError("Key (%s,%s,%s) already present" % tuple(p))
+        return tree.node([octree_from_list_inner(b, l, r, s, tree)
+                          for (b,r,s) in zip(boxes, starts, stops)])
+
+
+class FrozenTree(object):
+    """
+    A read-only copy of an octree, laid out for fast searches.
+
+    The nodes and points are numbered in depth-first order. For each
+    number we store the bounds of a node (or None for a point), the
+    (coords, data) pair of a point (or None for a node), and the
+    numbers of a node's nonempty children. Searches then need neither
+    compute sub-boxes nor visit empty octants.
+    """
+
+    __slots__ = ('bounds', 'points', 'children')
+
+    def __init__(self, bounds, tree):
+        self.bounds = []
+        self.points = []
+        self.children = []
+        self._add(bounds, tree)
+
+    def _add(self, bounds, tree):
+        i = len(self.points)
+        if tree._kind == 1:
+            self.bounds.append(None)
+            self.points.append((tree.coords, tree.data))
+            self.children.append(())
+        elif tree._kind == 2:
+            self.bounds.append(bounds)
+            self.points.append(None)
+            self.children.append(None)
+            self.children[i] = tuple(self._add(b, t)
+                                     for (b, t) in tree.children(bounds)
+                                     if t._kind)
+        return i
+
+    def __len__(self):
+        return len(self.points) - self.points.count(None)
+
+    def __iter__(self):
+        for t in self.points:
+            if t is not None:
+                yield t
+
+    def by_score(self, pointscore, boxscore):
+        """
+        As Octree.by_score.
+        """
+        bounds = self.bounds
+        points = self.points
+        children = self.children
+        found = []
+        boxes = []
+        push = heapq.heappush
+        pop = heapq.heappop
+        todo = (0,) if points else ()
+
+        while True:
+            for j in todo:
+                t = points[j]
+                if t is None:
+                    s = boxscore(bounds[j])
+                    if s is not None:
+                        # break ties by bounds, as Octree.by_score does
+                        push(boxes, (s, bounds[j], j))
+                else:
+                    s = pointscore(t[0])
+                    if s is not None:
+                        push(found, (s, t[0], t[1]))
+            while found and (not boxes or found[0][0] <= boxes[0][0]):
+                yield pop(found)
+            if not boxes:
+                return
+            todo = children[pop(boxes)[2]]
+
+    def by_distance_from_point(self, p, epsilon=None):
+        """
+        As Octree.by_distance_from_point.
+        """
+        for t in self.by_score(*distance_functions(p, epsilon)):
+            yield t
@@ -31,6 +31,9 @@ from octrees.geometry import *
 from octrees.inner.octree_inner import *
 
 
+_MISSING = object()
+
+
 class Octree():
     """
     Octrees: efficient data structure for data associated with points
@@ -45,6 +48,10 @@ class Octree():
         self.bounds = bounds
         self.tree = tree
 
+    def in_bounds(self, p):
+        "Does p lie within the bounds?"
+        return point_in_box(p, self.bounds)
+
     def check_bounds(self, p):
         if not point_in_box(p, self.bounds):
             raise KeyError("Point (%s, %s, %s) out of bounds" % p)
@@ -58,6 +65,10 @@ class Octree():
     def __iter__(self):
         return iter(self.tree)
 
+    def __contains__(self, p):
+        "Is there a point at p?"
+        return self.get(p, _MISSING) is not _MISSING
+
     def copy(self):
         """
         Return a copy of self.
@@ -67,6 +78,16 @@ class Octree():
         """
         return Octree(self.bounds, self.tree)
 
+    def freeze(self):
+        """
+        A read-only snapshot of the points, which supports iteration,
+        by_score and by_distance_from_point (yielding the same results
+        as here) but lays out the tree for faster searches. Useful
+        after all points have been added, when many searches are to
+        be made.
+        """
+        return FrozenTree(self.bounds, self.tree)
+
     def get(self, p, default=None):
         """
         Finds the data associated to the point at p.
@@ -100,10 +121,32 @@ class Octree():
         self.check_bounds(p)
         self.tree = self.tree.remove(self.bounds, p)
 
+    def discard(self, p):
+        """
+        Removes the point at p, if there is one (unlike the "remove"
+        method, this does not raise KeyError otherwise).
+        """
+        if p in self:
+            self.tree = self.tree.remove(self.bounds, p)
+
     def extend(self, g):
-        "Inserts all the points in g."
-        for (p, d) in g:
-            self.insert(p, d)
+        """
+        Inserts all the points in g; raises KeyError if any of them
+        are already present.
+
+        If there are at least as many new points as existing ones, the
+        tree is rebuilt in one go (which is faster than inserting the
+        points one at a time).
+        """
+        l = list(g)
+        if len(l) < len(self):
+            for (p, d) in l:
+                self.insert(p, d)
+        else:
+            for (p, d) in l:
+                self.check_bounds(p)
+            l.extend(self.tree)
+            self.tree = octree_from_list_inner(self.bounds, l, 0, len(l))
 
     def simple_union(self, other):
         """
@@ -175,20 +218,73 @@ class Octree():
             considered infinite: we cannot be interested in any point
             in that box.
 
-        The algorithm maintains a heap of points and boxes in order of
+        The algorithm maintains heaps of points and boxes in order of
         how promising they are. In particular, if only the earliest
         results are needed, not much extra processing is done.
         """
-        l = []
-        self.tree.enqueue(l, self.bounds, pointscore, boxscore)
+        # Points and boxes are kept in separate heaps, so that the
+        # entries are as small as possible and points come off their
+        # heap already in the form to be returned
+        points = []
+        boxes = []
+        push = heapq.heappush
+        pop = heapq.heappop
+        children = ((self.bounds, self.tree),)
+
+        while True:
+            for (b, t) in children:
+                k = t._kind
+                if k == 1:
+                    s = pointscore(t.coords)
+                    if s is not None:
+                        push(points, (s, t.coords, t.data))
+                elif k == 2:
+                    s = boxscore(b)
+                    if s is not None:
+                        push(boxes, (s, b, t))
+            while points and (not boxes or points[0][0] <= boxes[0][0]):
+                yield pop(points)
+            if not boxes:
+                return
+            (_, bounds, node) = pop(boxes)
+            children = node.children(bounds)
+
+    def by_score_bounded(self, pointscore, boxscore, k):
+        """
+        As by_score, but returns only the first k results.
+
+        Keeps track of the k best point scores enqueued so far; any
+        point or box scoring strictly worse than all of them is never
+        put on the heap (ties are kept, so that they are broken just
+        as by_score breaks them). This keeps the heap small when k is
+        much smaller than the number of points which would otherwise
+        be enqueued.
+        """
+        best = []  # the k lowest point scores seen so far, negated
+
+        def p_fn(p):
+            s = pointscore(p)
+            if s is not None:
+                if len(best) < k:
+                    heapq.heappush(best, -s)
+                elif s < -best[0]:
+                    heapq.heappushpop(best, -s)
+                elif s > -best[0]:
+                    return None
+            return s
 
-        while len(l) > 0:
-            (score, isnode, location, stuff) = heapq.heappop(l)
-            if isnode:
-                for (b, t) in stuff.children(location):
-                    t.enqueue(l, b, pointscore, boxscore)
-            else:
-                yield (score, location, stuff)
+        def b_fn(b):
+            s = boxscore(b)
+            if s is not None and len(best) == k and s > -best[0]:
+                return None
+            return s
+
+        if k <= 0:
+            return
+        for (i, t) in enumerate(self.by_score(p_fn, b_fn), 1):
+            yield t
+            if i == k:
+                return
 
     def by_distance_from_point(self, p, epsilon=None):
         """
@@ -199,12 +295,7 @@ class Octree():
         stops when the distance exceeds epsilon. This is more
         efficient than merely truncating the results.
         """
-        if epsilon is None:
-            p_fn = lambda q: euclidean_point_point(p, q)
-            b_fn = lambda b: euclidean_point_box(p, b)
-        else:
-            p_fn = lambda q: bounding(euclidean_point_point(p, q), epsilon)
-            b_fn = lambda b: bounding(euclidean_point_box(p, b), epsilon)
+        (p_fn, b_fn) = distance_functions(p, epsilon)
 
         for t in self.by_score(p_fn, b_fn):
             yield t
@@ -215,7 +306,7 @@ class Octree():
         (distance, coords, value), furthest first.
         """
         fp = lambda q: -euclidean_point_point(p, q)
-        fb = lambda b: min(-euclidean_point_point(p, q) for q in vertices(b))
+        fb = lambda b: -euclidean_point_box_max(p, b)
         for (d, c, v) in self.by_score(fp, fb):
             yield (-d, c, v)
 
@@ -227,13 +318,36 @@ class Octree():
         for t in self.by_distance_from_point(p):
             return t
 
+    def nearest_to_points(self, ps):
+        """
+        Return a list giving the nearest point to each of the points
+        ps, in the form (distance, coords, value).
+
+        For a large batch of points, searches a frozen copy of self
+        (see "freeze"), which is quicker to search but takes time to
+        build.
+        """
+        ps = list(ps)
+        if 8*len(ps) >= len(self):
+            f = self.freeze()
+            return [next(f.by_distance_from_point(p), None) for p in ps]
+        else:
+            return [self.nearest_to_point(p) for p in ps]
+
+    def k_nearest(self, p, k):
+        """
+        Return the k nearest points to p (or all of them, if there are
+        fewer), as a list in order of distance, in the form
+        (distance, coords, value).
+        """
+        return list(self.by_score_bounded(*distance_functions(p), k=k))
+
     def nearest_to_box(self, b):
         """
         Return the nearest point to a box, in the form (distance, coords,
         value).
         """
-        for t in self.by_score(lambda p: euclidean_point_box(p, b),
-                               lambda b2: euclidean_box_box(b2, b)):
+        for t in self.by_score(*box_distance_functions(b)):
             return t
 
     def nearest_to_box_far_corner(self, b):
@@ -345,7 +459,8 @@ class Octree():
 
         Bounds can be given.
         """
-        return self.deform(lambda p: matrix_action(matrix, p), bounds)
+        return self.deform(lambda p: matrix_action(matrix, p), bounds,
+                           lambda b: matrix_box_action(matrix, b))
 
     def pairs_by_score(self, other, p_p_score, p_b_score,
                        b_p_score, b_b_score):
@@ -420,10 +535,22 @@ class Octree():
         Returns pairs within epsilon of each other, one from each
         octree. Returns them in increasing order of distance.
         """
-        pp = lambda p1, p2: bounding(euclidean_point_point(p1, p2), epsilon)
-        bp1 = lambda p, b: bounding(euclidean_point_box(p, b), epsilon)
-        bp2 = lambda b, p: bounding(euclidean_point_box(p, b), epsilon)
-        bb = lambda b1, b2: bounding(euclidean_box_box(b1, b2), epsilon)
+        def pp(p1, p2):
+            d = euclidean_point_point(p1, p2)
+            return None if d > epsilon else d
+
+        def bp1(p, b):
+            d = euclidean_point_box(p, b)
+            return None if d > epsilon else d
+
+        def bp2(b, p):
+            d = euclidean_point_box(p, b)
+            return None if d > epsilon else d
+
+        def bb(b1, b2):
+            d = euclidean_box_box(b1, b2)
+            return None if d > epsilon else d
+
         for t in self.pairs_by_score(other, pp, bp1, bp2, bb):
             yield t
 
@@ -16,26 +16,15 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 """
-Miscellaneous helper code
+Helper code shared by the unit tests
 
 (C) James Cranch 2013--2021
 """
 
-def pivot(l, f, start, stop):
-    """
-    Swap elements of l over so that, in the range l[start:stop], all
-    elements satisfying f precede all those which don't.
+from math import sin
 
-    Returns the pivot point n such that l[start:n] all do and
-    l[n:stop] all don't.
-    """
-    while start < stop:
-        if f(l[start]):
-            start += 1
-        elif not f(l[stop-1]):
-            stop -= 1
-        else:
-            (l[start], l[stop-1]) = (l[stop-1], l[start])
-            start += 1
-            stop -= 1
-    return stop
+
+def make_coords(n, start=0):
+    "The points (sin(0.1t), sin(0.2t), sin(0.3t)) for n values of t"
+    return [(sin(0.1*t), sin(0.2*t), sin(0.3*t))
+            for t in range(start, start+n)]
@@ -22,10 +22,35 @@ Unit testing for the octrees library
 """
 
 from unittest import TestCase
-from math import sin
 
-from octrees.blob_octrees import BlobOctree
+from octrees.blob_octrees import BlobOctree, blob_octree_from_list
 from octrees.geometry import *
+from tests.helpers import make_coords
+
+
+def _make_extents(coords, m):
+    "Cubes of half-width m centred at the given points"
+    return [((x-m, x+m), (y-m, y+m), (z-m, z+m)) for (x, y, z) in coords]
+
+
+class BlobBuilderTests(TestCase):
+
+    def setUp(self):
+        self.b = ((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0))
+        coords = make_coords(50)
+        self.regions = list(zip(coords, _make_extents(coords, 0.1),
+                                range(50)))
+
+    def test_equality(self):
+        o1 = BlobOctree(self.b)
+        for (p, b, d) in self.regions:
+            o1.insert(p, b, d)
+        o2 = blob_octree_from_list(self.b, list(self.regions))
+        self.assertEqual(o1, o2)
+
+    def test_duplicates(self):
+        with self.assertRaises(KeyError):
+            blob_octree_from_list(self.b, self.regions + self.regions[:1])
 
 
 class BlobTests(TestCase):
@@ -34,38 +59,51 @@ class BlobTests(TestCase):
         self.o1 = BlobOctree(((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0)))
         self.o2 = BlobOctree(((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0)))
 
-        self.coords = [(sin(0.1*t), sin(0.2*t), sin(0.3*t))
-                       for t in range(100)]
-        m = 0.1
-        self.extents = [((x-m, x+m), (y-m, y+m), (z-m, z+m))
-                        for (x, y, z) in self.coords]
+        self.coords = make_coords(100)
+        self.extents = _make_extents(self.coords, 0.1)
         arguments = list(zip(self.coords, self.extents, range(100)))
+        self.items1 = arguments[:50]
+        self.items2 = arguments[50:]
+        self.set1 = frozenset(self.items1)
+        self.set2 = frozenset(self.items2)
 
-        self.o1.extend(arguments[:50])
-        self.o2.extend(arguments[50:])
+        self.o1.extend(self.items1)
+        self.o2.extend(self.items2)
 
     def test_basic(self):
         self.assertEqual(len(self.o1), 50)
-        self.assertEqual(set(self.o1),
-                         set(zip(self.coords[:50],
-                                 self.extents[:50],
-                                 range(50))))
+        self.assertEqual(set(self.o1), self.set1)
         self.assertEqual(len(self.o2), 50)
-        self.assertEqual(set(self.o2),
-                         set(zip(self.coords[50:],
-                                 self.extents[50:],
-                                 range(50, 100))))
+        self.assertEqual(set(self.o2), self.set2)
+
+    def test_in_bounds(self):
+        self.assertTrue(self.o1.in_bounds((0.35, -0.87, 0.56)))
+        self.assertTrue(self.o1.in_bounds((-1.0, -1.0, -1.0)))
+        for p in [(1.35, 0.87, 0.56), (-1.43, 0.87, 0.56),
+                  (0.35, 1.94, 0.56), (0.35, -1.51, 0.56),
+                  (0.35, 0.87, 1.0), (0.35, 0.87, -1.35)]:
+            self.assertFalse(self.o1.in_bounds(p))
 
     def test_intersect_with_box(self):
         b1 = ((-0.5, 0.5), (-0.2, 0.8), (-0.7, 0.3))
         s1 = set(self.o1.intersect_with_box(b1))
         s2 = set(self.o1.intersection_with_box(b1))
         s3 = set((p, b, d)
-                 for (p, b, d) in self.o1
+                 for (p, b, d) in self.items1
                  if not boxes_disjoint(b, b1))
         self.assertEqual(s1, s3)
         self.assertEqual(s2, s3)
 
+    def test_freeze(self):
+        f = self.o1.freeze()
+        self.assertEqual(len(f), 50)
+        self.assertEqual(set(f), self.set1)
+        for b1 in [((-0.5, 0.5), (-0.2, 0.8), (-0.7, 0.3)),
+                   ((-2.0, 2.0), (-2.0, 2.0), (-2.0, 2.0)),
+                   ((3.0, 4.0), (3.0, 4.0), (3.0, 4.0))]:
+            self.assertEqual(set(f.intersect_with_box(b1)),
+                             set(self.o1.intersect_with_box(b1)))
+
     def test_possible_overlaps(self):
         s1 = set((x[2], y[2]) for (x, y) in self.o1.possible_overlaps(self.o2))
 
@@ -77,44 +115,50 @@ class BlobTests(TestCase):
                  for x in self.o1
                  for y in self.o2.intersect_with_box(x[1]))
 
-        s0 = set((x[2], y[2])
-                 for x in self.o1
-                 for y in self.o2
-                 if not boxes_disjoint(x[1], y[1]))
+        # boxes which merely touch count as disjoint
+        s0 = set((d1, d2)
+                 for (_, b1, d1) in self.items1
+                 for (_, b2, d2) in self.items2
+                 if all(max(b1[k][0], b2[k][0]) < min(b1[k][1], b2[k][1])
+                        for k in range(3)))
 
         self.assertEqual(s1, s0)
         self.assertEqual(s2, s0)
         self.assertEqual(s3, s0)
 
     def test_intersect_with_line(self):
-        for xi in range(-8, 8, 2):
-            x = xi/10
-            for yi in range(-8, 8, 2):
-                y = yi/10
-                for zi in range(-8, 8, 2):
-                    z = zi/10
-
-                    def decent(t):
-                        ((minx, maxx), (miny, maxy), (minz, maxz)) = t
-                        return maxx > x and miny < y < maxy and minz < z < maxz
-
-                    s0 = set(self.o1.intersect_with_line((x, y, z), (1, 0, 0)))
-                    s1 = set(t for t in self.o1 if decent(t[1]))
-
+        # The lines run parallel to the x axis, so which boxes they
+        # meet in y and z can be worked out once for all x
+        for yi in range(-8, 8, 2):
+            y = yi/10
+            for zi in range(-8, 8, 2):
+                z = zi/10
+                crossed = []
+                for t in self.items1:
+                    (_, ((_, maxx), (miny, maxy), (minz, maxz)), _) = t
+                    if miny < y < maxy and minz < z < maxz:
+                        crossed.append((maxx, t))
+                for xi in range(-8, 8, 2):
+                    x = xi/10
+                    s0 = set(self.o1.intersect_with_line((x, y, z),
+                                                         (1, 0, 0)))
+                    s1 = set(t for (maxx, t) in crossed if maxx > x)
                     self.assertEqual(s0, s1)
 
     def test_intersect_with_line_segment(self):
-        s0 = set(self.o1.intersect_with_line_segment((-0.5, -0.5, -0.5),
-                                                     (0.5, 0.5, 0.5)))
-        s1 = set()
-        for t in zip(self.coords, self.extents, range(50)):
-            (p, b, n) = t
-            for i in range(-500, 501):
-                x = (i/1000.0, i/1000.0, i/1000.0)
-                if point_in_box(x, b):
+        for ci in range(-4, 5):
+            c = ci/10
+            s0 = set(self.o1.intersect_with_line_segment((c-0.5, -0.5, -0.5),
+                                                         (c+0.5, 0.5, 0.5)))
+            # The segment is the points (r+c, r, r) for r between -0.5
+            # and 0.5, so it meets a box when these intervals overlap
+            s1 = set()
+            for t in self.items1:
+                (_, ((minx, maxx), (miny, maxy), (minz, maxz)), _) = t
+                if (max(minx-c, miny, minz, -0.5)
+                        <= min(maxx-c, maxy, maxz, 0.5)):
                     s1.add(t)
-                    break
-        self.assertEqual(s0, s1)
+            self.assertEqual(s0, s1)
 
     def test_intersect_with_plane(self):
         for d in [0]:
@@ -122,7 +166,7 @@ class BlobTests(TestCase):
 
             s0 = set(self.o1.intersect_with_plane(fn))
             s1 = set()
-            for t in zip(self.coords, self.extents, range(50)):
+            for t in self.items1:
                 (_, b, _) = t
                 if b[d][0] <= 0.25 <= b[d][1]:
                     s1.add(t)
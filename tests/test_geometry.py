@@ -49,6 +49,12 @@ class GeometryTests(TestCase):
                 self.random_interval(n, a, b),
                 self.random_interval(n, a, b))
 
+    def test_point_against_points(self):
+        p = self.random_point(100, 0.01, -0.5)
+        l = [self.random_point(100, 0.01, -0.5) for i in range(100)]
+        self.assertEqual(euclidean_point_points(p, l),
+                         [euclidean_point_point(p, q) for q in l])
+
     def test_point_against_box(self):
         for i in range(10):
             b = self.random_box(100, 2, 0)
@@ -59,6 +65,16 @@ class GeometryTests(TestCase):
                 d = max(euclidean_point_point(p, v) for v in vertices(b))
                 self.assertEqual(euclidean_point_box_max(p, b), d)
 
+    def test_centre_against_box(self):
+        # the furthest vertices are tied here, and must still give
+        # exactly the same distance
+        for i in range(100):
+            b = tuple(sorted((random.random(), random.random()))
+                      for k in range(3))
+            p = centroid(b)
+            d = max(euclidean_point_point(p, v) for v in vertices(b))
+            self.assertEqual(euclidean_point_box_max(p, b), d)
+
     def test_box_against_box(self):
         for i in range(10):
             a = self.random_box(100, 2, 0)
@@ -73,6 +89,77 @@ class GeometryTests(TestCase):
             self.assertEqual(d1, d0)
             self.assertEqual(d2, d0)
 
+    def test_box_against_box_fractional(self):
+        for i in range(100):
+            a = self.random_box(100, 0.013, -0.7)
+            b = self.random_box(100, 0.017, -0.4)
+            d0 = max(euclidean_point_point(u, v)
+                     for u in vertices(a)
+                     for v in vertices(b))
+            self.assertEqual(euclidean_box_box_max(a, b), d0)
+
+    def test_distance_functions(self):
+        for i in range(10):
+            p = self.random_point(100, 2, 1)
+            (f, g) = distance_functions(p)
+            (f1, g1) = distance_functions(p, 50)
+
+            for j in range(10):
+                q = self.random_point(100, 2, 0)
+                b = self.random_box(100, 2, 0)
+
+                self.assertEqual(f(q), euclidean_point_point(p, q))
+                self.assertEqual(g(b), euclidean_point_box(p, b))
+                self.assertEqual(f1(q), bounding(f(q), 50))
+                self.assertEqual(g1(b), bounding(g(b), 50))
+
+    def test_box_distance_functions(self):
+        for i in range(10):
+            b = self.random_box(100, 2, 1)
+            (f, g) = box_distance_functions(b)
+
+            for j in range(10):
+                p = self.random_point(100, 2, 0)
+                b2 = self.random_box(100, 2, 0)
+
+                self.assertEqual(f(p), euclidean_point_box(p, b))
+                self.assertEqual(g(b2), euclidean_box_box(b2, b))
+
+    def test_boxes_disjoint(self):
+        for i in range(100):
+            a = self.random_box(10, 2, 0)
+            b = self.random_box(10, 2, 1)
+
+            overlap = all(max(a[k][0], b[k][0]) < min(a[k][1], b[k][1])
+                          for k in range(3))
+            self.assertEqual(boxes_disjoint(a, b), not overlap)
+            self.assertEqual(boxes_disjoint(b, a), not overlap)
+
+    def test_box_relation(self):
+        for i in range(100):
+            a = self.random_box(10, 2, 0)
+            b = self.random_box(10, 2, 1)
+
+            if boxes_disjoint(a, b):
+                r = False
+            elif box_contains(a, b):
+                r = True
+            else:
+                r = None
+            self.assertIs(box_relation(a, b), r)
+
+    def test_flat_boxes(self):
+        for i in range(100):
+            a = self.random_box(10, 2, 0)
+            b = self.random_box(10, 2, 1)
+            e1 = flatten_box(a)
+            e2 = flatten_box(b)
+
+            self.assertEqual(unflatten_box(e1), a)
+            self.assertEqual(boxes_disjoint_flat(e1, e2),
+                             boxes_disjoint(a, b))
+            self.assertIs(box_relation_flat(e1, e2), box_relation(a, b))
+
     def test_line_segment_against_box1(self):
         b = ((-0.0831860995156494, 0.11681390048435061),
              (-0.06637695277886153, 0.1336230472211385),
@@ -97,3 +184,28 @@ class GeometryTests(TestCase):
              (0.4646424733950354, 0.6646424733950353))
         f = lambda p: p[0]-0.25
         self.assertTrue(box_intersects_plane(b, f))
+
+    def test_line_intersection_function(self):
+        for i in range(100):
+            a = self.random_point(10, 2, 0)
+            v = self.random_point(3, 1, -2)
+            e = flatten_box(self.random_box(10, 2, 1))
+            for (positive, f) in [(True, halfline_intersects_box_flat),
+                                  (False, line_intersects_box_flat)]:
+                g = line_intersection_function(a, v, positive)
+                self.assertEqual(g(e), f(a, v, e))
+        # the reciprocal of a subnormal component overflows
+        (a, v, e) = ((0, 0, 0), (5e-324, 1, 0), (0, 1, -5, -4, -1, 1))
+        for (positive, f) in [(True, halfline_intersects_box_flat),
+                              (False, line_intersects_box_flat)]:
+            self.assertFalse(f(a, v, e))
+            self.assertFalse(line_intersection_function(a, v, positive)(e))
+
+    def test_matrix_box_action(self):
+        for i in range(100):
+            m = tuple(tuple(random.uniform(-1, 1) for j in range(3))
+                      for k in range(3))
+            b = self.random_box(100, 0.013, -0.7)
+            self.assertEqual(matrix_box_action(m, b),
+                             convex_box_deform(lambda p: matrix_action(m, p),
+                                               b))
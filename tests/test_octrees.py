@@ -22,10 +22,12 @@ Unit testing for the octrees library
 """
 
 from unittest import TestCase
-from math import sin
+from heapq import nsmallest
 
 from octrees import Octree, octree_from_list
 from octrees.geometry import *
+from octrees.inner.octree_inner import Node, Singleton
+from tests.helpers import make_coords
 
 
 class BasicTests(TestCase):
@@ -39,6 +41,14 @@ class BasicTests(TestCase):
     def test_size(self):
         self.assertEqual(len(self.o), 3)
 
+    def test_in_bounds(self):
+        self.assertTrue(self.o.in_bounds((0.35, 0.87, 0.56)))
+        self.assertTrue(self.o.in_bounds((0.0, 0.0, 0.0)))
+        for p in [(2.35, 0.87, 0.56), (-0.43, 0.87, 0.56),
+                  (0.35, 1.94, 0.56), (0.35, -0.51, 0.56),
+                  (0.35, 0.87, 1.04), (0.35, 0.87, -0.35)]:
+            self.assertFalse(self.o.in_bounds(p))
+
     def test_thinking_outside_box(self):
         with self.assertRaises(KeyError):
             self.o.insert((2.35, 0.87, 0.56), "> maxx")
@@ -53,6 +63,15 @@ class BasicTests(TestCase):
         with self.assertRaises(KeyError):
             self.o.insert((0.35, 0.87, -0.35), "< minz")
 
+    def test_discard(self):
+        self.assertIn((0.12, 0.34, 0.56), self.o)
+        self.o.discard((0.12, 0.34, 0.56))
+        self.assertNotIn((0.12, 0.34, 0.56), self.o)
+        self.assertEqual(len(self.o), 2)
+        self.o.discard((0.12, 0.34, 0.56))
+        self.o.discard((2.35, 0.87, 0.56))
+        self.assertEqual(len(self.o), 2)
+
     def test_update_insert(self):
         with self.assertRaises(KeyError):
             self.o.insert((0.33, 0.66, 0.99), "Point one, renewed")
@@ -66,21 +85,42 @@ class BuilderTests(TestCase):
 
     def setUp(self):
         b = ((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0))
-        points = [((sin(0.1*t), sin(0.2*t), sin(0.3*t)), t)
-                  for t in range(50)]
+        points = [(p, t) for (t, p) in enumerate(make_coords(50))]
         self.o1 = Octree(b)
-        self.o1.extend(points)
+        for (p, d) in points:
+            self.o1.insert(p, d)
         self.o2 = octree_from_list(b, points)
+        self.b = b
+        self.points = points
 
     def test_equality(self):
         self.assertEqual(self.o1, self.o2)
 
+    def test_extend(self):
+        for n in [0, 10, 25, 40, 50]:
+            o = Octree(self.b)
+            o.extend(self.points[:n])
+            o.extend(self.points[n:])
+            self.assertEqual(o, self.o1)
+
+    def test_extend_duplicates(self):
+        for n in [10, 25, 40]:
+            o = Octree(self.b)
+            o.extend(self.points[:n])
+            with self.assertRaises(KeyError):
+                o.extend(self.points[n-1:])
+
+    def test_nested_content(self):
+        l = [Singleton((0.1*i, 0.1*i, 0.1*i), i) for i in range(8)]
+        n = Node([[l[0:2], l[2:4]], [l[4:6], l[6:8]]])
+        self.assertEqual(n, Node(l))
+        self.assertEqual(len(n), 8)
+
 
 class GeometricTests(TestCase):
 
     def setUp(self):
-        self.coords = set((sin(0.1*t), sin(0.2*t), sin(0.3*t))
-                          for t in range(50))
+        self.coords = set(make_coords(50))
         self.o = Octree(((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0)))
         self.o.extend((p, True) for p in self.coords)
 
@@ -119,10 +159,35 @@ class GeometricTests(TestCase):
         nearest point to p should be the first in order of distance
         from p""")
 
+        for k in [0, 1, 5, 50, 100]:
+            l4 = list(self.o.by_score_bounded(*distance_functions(p), k=k))
+            self.assertEqual(l4, l1[:k], """the bounded search should
+            return an initial segment of the points in order of distance
+            from p""")
+
+        self.assertEqual(self.o.nearest_to_point(p)[0],
+                         min(euclidean_point_points(p, self.coords)))
+
+        for k in [1, 7, 60]:
+            l5 = nsmallest(k, ((euclidean_point_point(p, c), c, True)
+                               for c in self.coords))
+            self.assertEqual(self.o.k_nearest(p, k), l5)
+
         l3 = list(self.o.by_distance_from_point(p, 1.3))
         self.assertEqual(l3, l1[:len(l3)], """the points near p should
         be an initial segment of the points in order of distance from p""")
 
+    def test_freeze(self):
+        f = self.o.freeze()
+        self.assertEqual(len(f), 50)
+        self.assertEqual(set(f), set(self.o))
+        for p in [(0.123, 0.456, 0.789), (1.5, -1.5, 0.0)]:
+            self.assertEqual(list(f.by_distance_from_point(p)),
+                             list(self.o.by_distance_from_point(p)))
+            self.assertEqual(list(f.by_distance_from_point(p, 0.9)),
+                             list(self.o.by_distance_from_point(p, 0.9)))
+        self.assertEqual(list(Octree(self.o.bounds).freeze()), [])
+
     def test_embiggen(self):
         b = ((-1.0, 1.6), (-1.0, 1.6), (-1.0, 1.6))
         o2 = self.o.rebound(b)
@@ -152,10 +217,12 @@ class GeometricTests(TestCase):
         l = list(self.o.by_distance_from_point(p))
         n = len(l)
         for (i, (_, c, _)) in enumerate(l):
+            self.assertIn(c, self.o)
             self.o.remove(c)
             self.assertEqual(len(self.o), n-i-1)
-            with self.assertRaises(KeyError):
-                self.o.remove(c)
+            self.assertNotIn(c, self.o)
+        with self.assertRaises(KeyError):
+            self.o.remove(l[0][1])
 
     def test_union(self):
         p = (0.236, -0.532, -0.117)
@@ -195,42 +262,84 @@ class GeometricTests(TestCase):
 
     def test_point_within_distance(self):
         epsilon = 0.1
-        for t in range(150, 200):
-            p = (sin(0.1*t), sin(0.2*t), sin(0.3*t))
+        coords = list(self.coords)
+        for p in make_coords(50, 150):
+            g = self.o.by_distance_from_point(p, epsilon)
+            f_computed = next(g, None) is not None
+            f_real = min(euclidean_point_points(p, coords)) < epsilon
+            self.assertEqual(f_computed, f_real)
 
-            try:
-                next(self.o.by_distance_from_point(p, epsilon))
-                f_computed = True
-            except StopIteration:
-                f_computed = False
 
-            f_real = False
-            for (q, _) in self.o:
-                if euclidean_point_point(p, q) < epsilon:
-                    f_real = True
-                    break
+class TieTests(TestCase):
+    "Points on a grid, so that many distances are tied"
 
-            self.assertEqual(f_computed, f_real)
+    def setUp(self):
+        v = [0.25*i for i in range(-3, 4)]
+        self.coords = [(x, y, z)
+                       for (i, x) in enumerate(v)
+                       for (j, y) in enumerate(v)
+                       for (k, z) in enumerate(v)
+                       if (i + 2*j + 4*k) % 3 == 0]
+        self.o = Octree(((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0)))
+        self.o.extend((p, True) for p in self.coords)
+        self.queries = [(x, y, z)
+                        for x in v[::2] for y in v[1::2] for z in v[::3]]
+
+    def test_freeze(self):
+        f = self.o.freeze()
+        for q in self.queries:
+            self.assertEqual(list(f.by_distance_from_point(q)),
+                             list(self.o.by_distance_from_point(q)))
+
+    def test_k_nearest(self):
+        for q in self.queries:
+            l = list(self.o.by_distance_from_point(q))
+            for k in [1, 2, 3, 5, 8]:
+                self.assertEqual(self.o.k_nearest(q, k), l[:k])
+                self.assertEqual(
+                    list(self.o.by_score_bounded(*distance_functions(q),
+                                                 k=k)),
+                    l[:k])
+
+    def test_k_nearest_tie(self):
+        o = Octree(((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0)))
+        o.extend([((-0.25, 0.25, 0.5), 1),
+                  ((0.0, 0.5, -0.5), 2),
+                  ((0.5, 0.25, 0.0), 3)])
+        q = (0.0, 0.25, 0.0)
+        self.assertEqual(o.k_nearest(q, 2),
+                         list(o.by_distance_from_point(q))[:2])
+
+    def test_nearest_to_points(self):
+        # small batches search the tree, large ones a frozen copy
+        for n in [1, 5, len(self.queries)]:
+            ps = self.queries[:n]
+            self.assertEqual(self.o.nearest_to_points(ps),
+                             [self.o.nearest_to_point(p) for p in ps])
 
 
 class BinaryTests(TestCase):
 
     def setUp(self):
-        self.coords1 = set((sin(0.1*t), sin(0.2*t), sin(0.3*t))
-                           for t in range(50))
+        self.coords1 = set(make_coords(50))
         self.o1 = Octree(((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0)))
         self.o1.extend((p, None) for p in self.coords1)
 
-        self.coords2 = set((sin(0.1*t), sin(0.2*t), sin(0.3*t))
-                           for t in range(150, 200))
+        self.coords2 = set(make_coords(50, 150))
         self.o2 = Octree(((-1.0, 1.0), (-1.0, 1.0), (-1.0, 1.0)))
         self.o2.extend((p, None) for p in self.coords2)
 
+    def test_nearest_to_points(self):
+        for n in [0, 1, 50]:
+            ps = list(self.coords1)[:n]
+            self.assertEqual(self.o2.nearest_to_points(ps),
+                             [self.o2.nearest_to_point(p) for p in ps])
+
     def test_proximity(self):
-        l1 = []
-        for c1 in self.coords1:
-            (d, c2, _) = self.o2.nearest_to_point(c1)
-            l1.append((d, c1, c2, None, None))
+        coords1 = list(self.coords1)
+        l1 = [(d, c1, c2, None, None)
+              for (c1, (d, c2, _)) in zip(coords1,
+                                          self.o2.nearest_to_points(coords1))]
         l1.sort()
         l2 = list(self.o1.by_proximity(self.o2))
         self.assertEqual(l1, l2)
@@ -240,10 +349,10 @@ class BinaryTests(TestCase):
         self.assertEqual(l1b, l2b)
 
     def test_isolation(self):
-        l1 = []
-        for c1 in self.coords1:
-            (d, c2, _) = self.o2.nearest_to_point(c1)
-            l1.append((d, c1, c2, None, None))
+        coords1 = list(self.coords1)
+        l1 = [(d, c1, c2, None, None)
+              for (c1, (d, c2, _)) in zip(coords1,
+                                          self.o2.nearest_to_points(coords1))]
         l1.sort(reverse=True)
         l2 = list(self.o1.by_isolation(self.o2))
         self.assertEqual(l1, l2)
@@ -254,9 +363,9 @@ class BinaryTests(TestCase):
 
     def test_pairs_by_distance(self):
         l1 = []
+        coords2 = list(self.coords2)
         for c1 in self.coords1:
-            for c2 in self.coords2:
-                d = euclidean_point_point(c1, c2)
+            for (d, c2) in zip(euclidean_point_points(c1, coords2), coords2):
                 if d < 0.1:
                     l1.append((d, c1, c2, None, None))
         l1.sort()
@@ -265,9 +374,9 @@ class BinaryTests(TestCase):
 
     def test_pairs_nearby(self):
         s1 = set()
+        coords2 = list(self.coords2)
         for c1 in self.coords1:
-            for c2 in self.coords2:
-                d = euclidean_point_point(c1, c2)
+            for (d, c2) in zip(euclidean_point_points(c1, coords2), coords2):
                 if d < 0.1:
                     s1.add((c1, c2, None, None))
         s2 = set(self.o1.pairs_nearby(self.o2, 0.1))